@@ -18,8 +18,32 @@ _ = ugettext
 
 
 try:
-    import ujson as json  # noqa: F401
+    import orjson
+
+    class json(object):
+        """Exposes orjson through the subset of the json module interface used by this package.
+        """
+        JSONDecodeError = orjson.JSONDecodeError
+
+        @staticmethod
+        def loads(s):
+            # orjson decodes bytes, bytearray, memoryview and str directly
+            return orjson.loads(s)
+
+        @staticmethod
+        def dumps(obj):
+            # orjson returns bytes, the json module returns str. Non-str keys are converted like the json module does
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+except ImportError:
+    orjson = None
+    try:
+        import ujson as json  # noqa: F401
+    except ImportError:
+        import json  # noqa: F401
+
+try:
+    import msgpack  # noqa: F401
 except ImportError:
-    import json  # noqa: F401
+    msgpack = None
 
 import zmq  # noqa: F401 # TODO: stub zmq
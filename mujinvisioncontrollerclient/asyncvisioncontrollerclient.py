@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2023 MUJIN Inc
+# Asyncio Mujin vision controller client for bin picking task
+
+# system imports
+import asyncio
+import collections
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from typing import Any, Deque, Dict, List, Optional, Tuple # noqa: F401 # used in type check
+    import mujinvisiontypes as types
+
+# mujin imports
+from . import VisionControllerClientError, VisionControllerTimeoutError
+from . import json
+from . import orjson
+from . import zmq
+from . import ugettext as _
+from .visioncontrollerclient import _GetDefaultContext, _ProcessResponse
+
+# logging
+import logging
+log = logging.getLogger(__name__)
+
+def _EncodeCommand(command):
+    # type: (Dict) -> bytes
+    """Encodes a command to json bytes. orjson is called directly to skip the str round trip of the json shim, and accepts non-str keys like the json module.
+    """
+    if orjson is not None:
+        return orjson.dumps(command, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(command).encode('utf-8')
+
+class _AsyncCommandSocket(object):
+    """Sends requests to a REP socket of the vision manager over a DEALER socket, so that several requests can be in flight.
+
+    The vision manager answers the requests one after the other, so the responses are matched to the requests in order. Once a response is lost, e.g. when the vision manager restarts, this order is broken, so the socket has to be reset when a request times out. Responses are read from the zeromq file descriptor registered with the event loop, without pyzmq creating a Future per receive.
+    """
+
+    _ctx = None  # type: Optional[zmq.Context]
+    _endpoint = None  # type: Optional[str]
+    _socket = None  # type: Optional[zmq.Socket]
+    _fd = None  # type: Optional[int] # file descriptor of _socket, registered with the event loop
+    _loop = None  # type: Optional[asyncio.AbstractEventLoop]
+    _pending = None  # type: Optional[Deque[Tuple[Optional[asyncio.Future], bool]]] # futures waiting for a response in request order, None for fire and forget requests, and whether the response is json
+
+    def __init__(self, ctx, endpoint, loop):
+        # type: (zmq.Context, str, asyncio.AbstractEventLoop) -> None
+        self._ctx = ctx
+        self._endpoint = endpoint
+        self._loop = loop
+        self._pending = collections.deque()
+        self._Connect()
+
+    def _Connect(self):
+        # type: () -> None
+        self._socket = self._ctx.socket(zmq.DEALER)
+        self._socket.linger = 100
+        self._socket.connect(self._endpoint)
+        self._fd = self._socket.getsockopt(zmq.FD)
+        self._loop.add_reader(self._fd, self._OnReadable)
+
+    def _Close(self):
+        # type: () -> None
+        if self._socket is not None:
+            self._loop.remove_reader(self._fd)
+            self._socket.close()
+            self._socket = None
+
+    def Send(self, payload, recvjson=True, fireandforget=False):
+        # type: (bytes, bool, bool) -> Optional[asyncio.Future]
+        """Sends a request.
+
+        Returns:
+            asyncio.Future: Resolved with the response, or None if fireandforget is True.
+        """
+        assert self._socket is not None
+        try:
+            # the empty delimiter frame is what a REQ socket would send before the payload
+            self._socket.send_multipart([b'', payload], flags=zmq.NOBLOCK)
+        except zmq.Again:
+            raise VisionControllerClientError(_('Cannot queue vision command, too many requests in flight'), errortype='busy')
+        future = None if fireandforget else self._loop.create_future()
+        self._pending.append((future, recvjson))
+        # the zeromq file descriptor is edge triggered and sending can consume the edge of a response that is already queued
+        self._loop.call_soon(self._OnReadable)
+        return future
+
+    def _OnReadable(self):
+        # type: () -> None
+        if self._socket is None:
+            return
+        # drain everything, the file descriptor will not signal again for messages that are already queued
+        while self._socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            try:
+                frames = self._socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            if not self._pending:
+                log.warning('dropping vision response without pending request')
+                continue
+            future, recvjson = self._pending.popleft()
+            if future is None or future.done():
+                continue # fire and forget, or timed out
+            response = frames[-1]
+            if recvjson:
+                try:
+                    response = json.loads(response)
+                except ValueError as e:
+                    future.set_exception(VisionControllerClientError(_('Failed to decode vision response: %s') % e, errortype='invalidresponse'))
+                    continue
+            future.set_result(response)
+
+    def Reset(self):
+        # type: () -> None
+        """Closes and reconnects the socket after a lost response, like zmqclient does with its REQ socket. The responses of the requests still waiting cannot be matched anymore, so they fail.
+        """
+        self._Close()
+        while self._pending:
+            future = self._pending.popleft()[0]
+            if future is not None and not future.done():
+                future.set_exception(VisionControllerClientError(_('Vision connection was reset after a lost response'), errortype='connectionreset'))
+        self._Connect()
+
+    def Destroy(self):
+        # type: () -> None
+        self._Close()
+        while self._pending:
+            future = self._pending.popleft()[0]
+            if future is not None and not future.done():
+                future.cancel()
+
+class _AsyncSubscriber(object):
+    """Subscribes to the state published by the vision manager, reading from the zeromq file descriptor registered with the event loop.
+    """
+
+    _socket = None  # type: Optional[zmq.Socket]
+    _fd = None  # type: Optional[int]
+    _loop = None  # type: Optional[asyncio.AbstractEventLoop]
+    _latest = None  # type: Optional[bytes] # latest state received while nobody was waiting
+    _waiters = None  # type: Optional[List[asyncio.Future]]
+
+    def __init__(self, ctx, endpoint, loop):
+        # type: (zmq.Context, str, asyncio.AbstractEventLoop) -> None
+        self._loop = loop
+        self._waiters = []
+        self._socket = ctx.socket(zmq.SUB)
+        self._socket.linger = 100
+        self._socket.setsockopt(zmq.SUBSCRIBE, b'')
+        self._socket.connect(endpoint)
+        self._fd = self._socket.getsockopt(zmq.FD)
+        loop.add_reader(self._fd, self._OnReadable)
+        loop.call_soon(self._OnReadable)
+
+    async def Receive(self, timeout=None):
+        # type: (Optional[float]) -> Optional[bytes]
+        """Returns the latest state received since the last call, or waits for the next one. Returns None on timeout.
+        """
+        if self._latest is not None:
+            rawState, self._latest = self._latest, None
+            return rawState
+        future = self._loop.create_future()
+        self._waiters.append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            if future in self._waiters:
+                self._waiters.remove(future)
+
+    def _OnReadable(self):
+        # type: () -> None
+        if self._socket is None:
+            return
+        while self._socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            try:
+                self._latest = self._socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+        if self._latest is not None and self._waiters:
+            waiters, self._waiters = self._waiters, []
+            for future in waiters:
+                if not future.done():
+                    future.set_result(self._latest)
+            self._latest = None
+
+    def Destroy(self):
+        # type: () -> None
+        if self._socket is not None:
+            self._loop.remove_reader(self._fd)
+            self._socket.close()
+            self._socket = None
+        for future in self._waiters:
+            if not future.done():
+                future.cancel()
+        self._waiters = []
+
+class AsyncVisionControllerClient(object):
+    """Asyncio Mujin Vision Controller client for binpicking tasks.
+
+    Mirrors the commands of VisionControllerClient as coroutines. Several commands can be awaited concurrently, they are pipelined on the sockets and the responses are dispatched from event loop reader callbacks. Has to be used from a single event loop.
+    """
+
+    _ctx = None  # type: Optional[zmq.Context] # zeromq context to use, the process-wide context if not given
+    hostname = None  # type: Optional[str] # hostname of vision controller
+    commandport = None  # type: Optional[int] # command port of vision controller
+    configurationport = None  # type: Optional[int] # configuration port of vision controller, usually command port + 2
+    statusport = None  # type: Optional[int] # status publishing port of vision manager, usually command port + 3
+
+    _commandsocket = None  # type: Optional[_AsyncCommandSocket]
+    _configurationsocket = None  # type: Optional[_AsyncCommandSocket]
+    _subscriber = None  # type: Optional[_AsyncSubscriber]
+
+    _callerid = None # the callerid to send to vision
+    _isDestroyed = False # True once Destroy was called, commands fail then
+
+    def __init__(self, hostname='127.0.0.1', commandport=7004, ctx=None, callerid=None):
+        # type: (str, int, Optional[zmq.Context], Optional[str]) -> None
+        """Sets up parameters to connect to the vision server. The sockets are created on first use, in the running event loop.
+
+        Args:
+            hostname (str, optional): e.g. visioncontroller1
+            commandport (int, optional): e.g. 7004
+            ctx (zmq.Context, optional): The ZMQ context. If not given, the process-wide context shared with VisionControllerClient is used.
+            callerid (str, optional): The callerid to send to vision.
+        """
+        self.hostname = hostname
+        self.commandport = commandport
+        self.configurationport = commandport + 2
+        self.statusport = commandport + 3
+        self._callerid = callerid
+
+        self._ctx = ctx if ctx is not None else _GetDefaultContext()
+
+    def Destroy(self):
+        # type: () -> None
+        self._isDestroyed = True
+        for socket in (self._commandsocket, self._configurationsocket, self._subscriber):
+            if socket is not None:
+                try:
+                    socket.Destroy()
+                except Exception:
+                    log.exception('problem destroying socket')
+        self._commandsocket = None
+        self._configurationsocket = None
+        self._subscriber = None
+
+        self._ctx = None
+
+    def _CheckDestroyed(self):
+        # type: () -> None
+        if self._isDestroyed:
+            raise VisionControllerClientError(_('Vision controller client %s:%d is destroyed') % (self.hostname, self.commandport), errortype='destroyed')
+
+    async def _SendAndReceive(self, socket, command, fireandforget=False, timeout=2.0, recvjson=True):
+        # type: (_AsyncCommandSocket, Dict, bool, float, bool) -> Any
+        if self._callerid:
+            command['callerid'] = self._callerid
+        future = socket.Send(_EncodeCommand(command), recvjson=recvjson, fireandforget=fireandforget)
+        if future is None:
+            return None
+        try:
+            response = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # the response may still come and would be taken for the response of the next request
+            socket.Reset()
+            raise VisionControllerTimeoutError(_('Timed out after %.03f seconds to get response message %s from %s') % (timeout, command.get('command'), self.hostname), errortype='timeout')
+        return _ProcessResponse(response, command=command, recvjson=recvjson)
+
+    async def _ExecuteCommand(self, command, fireandforget=False, timeout=2.0, recvjson=True):
+        # type: (Dict, bool, float, bool) -> Any
+        """Executes given command on the command socket, see VisionControllerClient._ExecuteCommand.
+        """
+        self._CheckDestroyed()
+        if self._commandsocket is None:
+            self._commandsocket = _AsyncCommandSocket(self._ctx, 'tcp://%s:%d' % (self.hostname, self.commandport), asyncio.get_running_loop())
+        return await self._SendAndReceive(self._commandsocket, command, fireandforget=fireandforget, timeout=timeout, recvjson=recvjson)
+
+    async def _SendConfiguration(self, configuration, fireandforget=False, timeout=2.0, recvjson=True):
+        # type: (Dict, bool, float, bool) -> Any
+        """Sends a configuration command on the configuration socket, see VisionControllerClient._SendConfiguration.
+        """
+        self._CheckDestroyed()
+        if self._configurationsocket is None:
+            self._configurationsocket = _AsyncCommandSocket(self._ctx, 'tcp://%s:%d' % (self.hostname, self.configurationport), asyncio.get_running_loop())
+        return await self._SendAndReceive(self._configurationsocket, configuration, fireandforget=fireandforget, timeout=timeout, recvjson=recvjson)
+
+    #
+    # Commands
+    #
+
+    async def StartObjectDetectionTask(self, taskId=None, systemState=None, visionTaskParameters=None, timeout=2.0, **ignoredArgs):
+        # type: (Optional[str], Optional[types.SystemState], Optional[types.visionTaskObjectDetectionParametersSchema], float, Any) -> Optional[Dict[str, str]]
+        """See VisionControllerClient.StartObjectDetectionTask
+        """
+        command = {
+            'command': 'StartObjectDetectionTask',
+        }  # type: Dict[str, Any]
+        if taskId is not None:
+            command['taskId'] = taskId
+        if systemState is not None:
+            command['systemState'] = systemState
+        if visionTaskParameters is not None:
+            command['visionTaskParameters'] = visionTaskParameters
+        return await self._ExecuteCommand(command, timeout=timeout)
+
+    async def StartContainerDetectionTask(self, taskId=None, systemState=None, visionTaskParameters=None, timeout=2.0, **ignoredArgs):
+        # type: (Optional[str], Optional[types.SystemState], Optional[types.visionTaskContainerDetectionParametersSchema], float, Any) -> Optional[Dict[str, str]]
+        """See VisionControllerClient.StartContainerDetectionTask
+        """
+        command = {
+            'command': 'StartContainerDetectionTask',
+        }  # type: Dict[str, Any]
+        if taskId is not None:
+            command['taskId'] = taskId
+        if systemState is not None:
+            command['systemState'] = systemState
+        if visionTaskParameters is not None:
+            command['visionTaskParameters'] = visionTaskParameters
+        return await self._ExecuteCommand(command, timeout=timeout)
+
+    async def StartVisualizePointCloudTask(self, taskId=None, systemState=None, visionTaskParameters=None, timeout=2.0):
+        # type: (Optional[str], Optional[types.SystemState], Optional[types.visionTaskVisualizePointCloudParametersSchema], float) -> Optional[Dict]
+        """See VisionControllerClient.StartVisualizePointCloudTask
+        """
+        command = {
+            'command': 'StartVisualizePointCloudTask',
+        }  # type: Dict[str, Any]
+        if taskId is not None:
+            command['taskId'] = taskId
+        if systemState is not None:
+            command['systemState'] = systemState
+        if visionTaskParameters is not None:
+            command['visionTaskParameters'] = visionTaskParameters
+        return await self._ExecuteCommand(command, timeout=timeout)
+
+    async def StopTask(self, taskId=None, taskIds=None, taskType=None, taskTypes=None, cycleIndex=None, waitForStop=True, removeTask=False, fireandforget=False, timeout=2.0):
+        # type: (Optional[str], Optional[List[str]], Optional[str], Optional[List[str]], Optional[str], bool, bool, bool, float) -> Optional[Dict[str, bool]]
+        """See VisionControllerClient.StopTask
+        """
+        command = {
+            'command': 'StopTask',
+            'waitForStop': waitForStop,
+            'removeTask': removeTask,
+        }  # type: Dict[str, Any]
+        if taskId is not None:
+            command['taskId'] = taskId
+        if taskIds is not None:
+            command['taskIds'] = taskIds
+        if taskType is not None:
+            command['taskType'] = taskType
+        if taskTypes is not None:
+            command['taskTypes'] = taskTypes
+        if cycleIndex is not None:
+            command['cycleIndex'] = cycleIndex
+        return await self._ExecuteCommand(command, timeout=timeout, fireandforget=fireandforget)
+
+    async def ResumeTask(self, taskId=None, taskIds=None, taskType=None, taskTypes=None, cycleIndex=None, fireandforget=False, timeout=2.0):
+        # type: (Optional[str], Optional[List[str]], Optional[str], Optional[List[str]], Optional[str], bool, float) -> Optional[Dict[str, List[str]]]
+        """See VisionControllerClient.ResumeTask
+        """
+        command = {
+            'command': 'ResumeTask',
+        }  # type: Dict[str, Any]
+        if taskId is not None:
+            command['taskId'] = taskId
+        if taskIds is not None:
+            command['taskIds'] = taskIds
+        if taskType is not None:
+            command['taskType'] = taskType
+        if taskTypes is not None:
+            command['taskTypes'] = taskTypes
+        if cycleIndex is not None:
+            command['cycleIndex'] = cycleIndex
+        return await self._ExecuteCommand(command, timeout=timeout, fireandforget=fireandforget)
+
+    async def BackupVisionLog(self, cycleIndex, sensorTimestamps=None, fireandforget=False, timeout=2.0):
+        # type: (str, Optional[List[float]], bool, float) -> Optional[Dict]
+        """See VisionControllerClient.BackupVisionLog
+        """
+        command = {
+            'command': 'BackupDetectionLogs',
+            'cycleIndex': cycleIndex,
+        }  # type: Dict[str, Any]
+        if sensorTimestamps is not None:
+            command['sensorTimestamps'] = sensorTimestamps
+        return await self._ExecuteCommand(command, fireandforget=fireandforget, timeout=timeout)
+
+    async def GetLatestDetectedObjects(self, taskId=None, cycleIndex=None, taskType=None, timeout=2.0):
+        # type: (Optional[str], Optional[str], Optional[str], float) -> Optional[Dict[str, List[Dict]]]
+        """See VisionControllerClient.GetLatestDetectedObjects
+        """
+        command = {
+            'command': 'GetLatestDetectedObjects',
+        }  # type: Dict[str, Any]
+        if taskId is not None:
+            command['taskId'] = taskId
+        if cycleIndex is not None:
+            command['cycleIndex'] = cycleIndex
+        if taskType is not None:
+            command['taskType'] = taskType
+        return await self._ExecuteCommand(command, timeout=timeout)
+
+    async def GetLatestDetectionResultImages(self, taskId=None, cycleIndex=None, taskType=None, newerThanResultTimestampMS=0, sensorSelectionInfo=None, metadataOnly=False, imageTypes=None, limit=None, timeout=2.0):
+        # type: (Optional[str], Optional[str], Optional[str], int, Optional[Dict], bool, Optional[List], Optional[int], float) -> Optional[bytes]
+        """See VisionControllerClient.GetLatestDetectionResultImages
+        """
+        command = {
+            'command': 'GetLatestDetectionResultImages',
+            'newerThanResultTimestampMS': newerThanResultTimestampMS,
+            'metadataOnly': metadataOnly,
+        }  # type: Dict[str, Any]
+        if taskId is not None:
+            command['taskId'] = taskId
+        if cycleIndex is not None:
+            command['cycleIndex'] = cycleIndex
+        if taskType is not None:
+            command['taskType'] = taskType
+        if sensorSelectionInfo is not None:
+            command['sensorSelectionInfo'] = sensorSelectionInfo
+        if imageTypes is not None:
+            command['imageTypes'] = imageTypes
+        if limit is not None:
+            command['limit'] = limit
+        return await self._ExecuteCommand(command, timeout=timeout, recvjson=False)
+
+    async def GetDetectionHistory(self, timestamp, timeout=2.0):
+        # type: (int, float) -> Optional[bytes]
+        """See VisionControllerClient.GetDetectionHistory
+        """
+        command = {
+            'command': 'GetDetectionHistory',
+            'timestamp': timestamp,
+        }  # type: Dict[str, Any]
+        return await self._ExecuteCommand(command, timeout=timeout, recvjson=False)
+
+    async def GetVisionStatistics(self, taskId=None, cycleIndex=None, taskType=None, timeout=2.0):
+        # type: (Optional[str], Optional[str], Optional[str], float) -> Optional[Dict[str, List[Dict]]]
+        """See VisionControllerClient.GetVisionStatistics
+        """
+        command = {
+            'command': 'GetVisionStatistics',
+        }  # type: Dict[str, Any]
+        if taskId is not None:
+            command['taskId'] = taskId
+        if cycleIndex is not None:
+            command['cycleIndex'] = cycleIndex
+        if taskType is not None:
+            command['taskType'] = taskType
+        return await self._ExecuteCommand(command, timeout=timeout)
+
+    async def SendBatch(self, commands, timeout=2.0):
+        # type: (List[Dict[str, Any]], float) -> List[Any]
+        """See VisionControllerClient.SendBatch
+        """
+        callerid = self._callerid
+        if callerid:
+            for subcommand in commands:
+                subcommand['callerid'] = callerid
+        command = {
+            'command': 'Batch',
+            'subcommands': commands,
+        }  # type: Dict[str, Any]
+        response = await self._ExecuteCommand(command, timeout=timeout)
+        responses = response.get('responses') or []
+        if len(responses) != len(commands):
+            raise VisionControllerClientError(_('Vision batch of %(numCommands)d commands got %(numResponses)d responses') % {'numCommands': len(commands), 'numResponses': len(responses)}, errortype='invalidresponse')
+        return [_ProcessResponse(subresponse, command=subcommand) for subcommand, subresponse in zip(commands, responses)]
+
+    async def Ping(self, timeout=2.0):
+        # type: (float) -> Optional[Dict]
+        """See VisionControllerClient.Ping
+        """
+        command = {
+            'command': 'Ping',
+        }  # type: Dict[str, Any]
+        return await self._SendConfiguration(command, timeout=timeout)
+
+    async def SetLogLevel(self, componentLevels, timeout=2.0):
+        # type: (Dict, float) -> Optional[Dict]
+        """See VisionControllerClient.SetLogLevel
+        """
+        command = {
+            'command': 'SetLogLevel',
+            'componentLevels': componentLevels,
+        }  # type: Dict[str, Any]
+        return await self._SendConfiguration(command, timeout=timeout)
+
+    async def Cancel(self, timeout=2.0):
+        # type: (float) -> Optional[Dict]
+        """See VisionControllerClient.Cancel
+        """
+        log.info('Canceling command...')
+        command = {
+            'command': 'Cancel',
+        }  # type: Dict[str, Any]
+        response = await self._SendConfiguration(command, timeout=timeout)
+        log.info('Command is stopped.')
+        return response
+
+    async def Quit(self, timeout=2.0):
+        # type: (float) -> Optional[Dict]
+        """See VisionControllerClient.Quit
+        """
+        log.info('Stopping visionserver...')
+        command = {
+            'command': 'Quit',
+        }  # type: Dict[str, Any]
+        response = await self._SendConfiguration(command, timeout=timeout)
+        log.info('Visionserver is stopped.')
+        return response
+
+    async def GetTaskStateService(self, taskId=None, cycleIndex=None, taskType=None, timeout=4.0):
+        # type: (Optional[str], Optional[str], Optional[str], float) -> Optional[Dict[str, Any]]
+        """See VisionControllerClient.GetTaskStateService
+        """
+        command = {
+            'command': 'GetTaskState',
+        }  # type: Dict[str, Any]
+        if taskId is not None:
+            command['taskId'] = taskId
+        if cycleIndex is not None:
+            command['cycleIndex'] = cycleIndex
+        if taskType is not None:
+            command['taskType'] = taskType
+        return await self._SendConfiguration(command, timeout=timeout)
+
+    async def GetPublishedStateService(self, timeout=4.0):
+        # type: (float) -> Optional[Dict[str, Any]]
+        """See VisionControllerClient.GetPublishedStateService
+        """
+        command = {
+            'command': 'GetPublishedState',
+        }  # type: Dict[str, Any]
+        return await self._SendConfiguration(command, timeout=timeout)
+
+    # Subscription command (subscribes to the state)
+    async def GetPublishedState(self, timeout=None):
+        # type: (Optional[float]) -> Optional[Dict]
+        """Returns the latest state published by the vision manager since the last call, or waits for the next one.
+
+        Args:
+            timeout (float, optional): Time in seconds to wait for a state. If None, waits forever.
+
+        Returns:
+            dict: An unstructured dictionary, or None on timeout.
+        """
+        self._CheckDestroyed()
+        if self._subscriber is None:
+            self._subscriber = _AsyncSubscriber(self._ctx, 'tcp://%s:%d' % (self.hostname, self.statusport), asyncio.get_running_loop())
+        rawState = await self._subscriber.Receive(timeout=timeout)
+        if rawState is not None:
+            return json.loads(rawState)
+        return None
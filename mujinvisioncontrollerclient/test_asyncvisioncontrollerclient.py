@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2023 MUJIN Inc.
+
+import asyncio
+import json
+import unittest
+import zmq
+from mujinvisioncontrollerclient import VisionControllerClientError, VisionControllerTimeoutError
+from mujinvisioncontrollerclient import asyncvisioncontrollerclient
+
+
+class TestAsyncCommandSocket(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.ctx = zmq.Context()
+        # stands in for the REP socket of the vision manager, and shows the identity of each connection
+        self.server = self.ctx.socket(zmq.ROUTER)
+        self.server.linger = 0
+        port = self.server.bind_to_random_port('tcp://127.0.0.1')
+        self.client = asyncvisioncontrollerclient.AsyncVisionControllerClient(commandport=port, ctx=self.ctx)
+
+    async def asyncTearDown(self):
+        self.client.Destroy()
+        self.server.close()
+        self.ctx.term()
+
+    async def _ReceiveRequest(self):
+        # let the client send before polling
+        for _ in range(100):
+            if self.server.poll(10):
+                identity, delimiter, payload = self.server.recv_multipart()
+                return identity, json.loads(payload)
+            await asyncio.sleep(0)
+        self.fail('no request received')
+
+    def _Reply(self, identity, response):
+        self.server.send_multipart([identity, b'', json.dumps(response).encode('utf-8')])
+
+    async def test_pipelining(self):
+        first = asyncio.ensure_future(self.client.GetVisionStatistics(taskId='task1', timeout=2.0))
+        second = asyncio.ensure_future(self.client.GetLatestDetectedObjects(taskId='task1', timeout=2.0))
+        requests = [await self._ReceiveRequest(), await self._ReceiveRequest()]
+        # both requests are in flight before the first response
+        self.assertEqual([request['command'] for identity, request in requests], ['GetVisionStatistics', 'GetLatestDetectedObjects'])
+        for identity, request in requests:
+            self._Reply(identity, {'command': request['command']})
+        self.assertEqual(await first, {'command': 'GetVisionStatistics'})
+        self.assertEqual(await second, {'command': 'GetLatestDetectedObjects'})
+
+    async def test_timeout_drops_late_response(self):
+        task = asyncio.ensure_future(self.client.GetVisionStatistics(timeout=0.2))
+        oldidentity, request = await self._ReceiveRequest()
+        with self.assertRaises(VisionControllerTimeoutError):
+            await task
+        # the late response goes to the closed socket and is not taken for the response of the next request
+        self._Reply(oldidentity, {'command': 'GetVisionStatistics'})
+        task = asyncio.ensure_future(self.client.GetLatestDetectedObjects(timeout=2.0))
+        identity, request = await self._ReceiveRequest()
+        self.assertNotEqual(identity, oldidentity)
+        self._Reply(identity, {'command': request['command']})
+        self.assertEqual(await task, {'command': 'GetLatestDetectedObjects'})
+
+    async def test_timeout_fails_pending(self):
+        first = asyncio.ensure_future(self.client.GetVisionStatistics(timeout=0.2))
+        second = asyncio.ensure_future(self.client.GetLatestDetectedObjects(timeout=2.0))
+        await self._ReceiveRequest()
+        await self._ReceiveRequest()
+        with self.assertRaises(VisionControllerTimeoutError):
+            await first
+        with self.assertRaises(VisionControllerClientError) as cm:
+            await second
+        self.assertEqual(cm.exception._type, 'connectionreset')
+
+    async def test_destroyed(self):
+        self.client.Destroy()
+        with self.assertRaises(VisionControllerClientError) as cm:
+            await self.client.Ping()
+        self.assertEqual(cm.exception._type, 'destroyed')
+
+
+class TestEncodeCommand(unittest.TestCase):
+    def test_non_str_keys(self):
+        # the json module accepts int keys, so the encoder of the asyncio client has to as well
+        payload = asyncvisioncontrollerclient._EncodeCommand({'command': 'SetLogLevel', 'componentLevels': {1: 'debug'}})
+        self.assertEqual(json.loads(payload), {'command': 'SetLogLevel', 'componentLevels': {'1': 'debug'}})
+
+
+class TestAsyncSubscriber(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.ctx = zmq.Context()
+        self.publisher = self.ctx.socket(zmq.PUB)
+        self.publisher.linger = 0
+        self.publisher.bind('inproc://publishedstate')
+        self.subscriber = asyncvisioncontrollerclient._AsyncSubscriber(self.ctx, 'inproc://publishedstate', asyncio.get_running_loop())
+        # wait until the subscription reaches the publisher
+        for _ in range(100):
+            self.publisher.send(b'{}')
+            if await self.subscriber.Receive(timeout=0.01) is not None:
+                break
+        else:
+            self.fail('subscription not established')
+
+    async def asyncTearDown(self):
+        self.subscriber.Destroy()
+        self.publisher.close()
+        self.ctx.term()
+
+    async def test_drains_to_latest(self):
+        for index in range(3):
+            self.publisher.send(json.dumps({'index': index}).encode('utf-8'))
+        await asyncio.sleep(0.05)
+        self.assertEqual(json.loads(await self.subscriber.Receive(timeout=1.0)), {'index': 2})
+        self.assertIsNone(await self.subscriber.Receive(timeout=0.05))
+
+    async def test_waiter(self):
+        waiter = asyncio.ensure_future(self.subscriber.Receive(timeout=1.0))
+        await asyncio.sleep(0)
+        self.publisher.send(b'{"index": 0}')
+        self.assertEqual(await waiter, b'{"index": 0}')
+
+
+if __name__ == "__main__":
+    unittest.main()
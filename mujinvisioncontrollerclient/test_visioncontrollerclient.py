@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2023 MUJIN Inc.
+
+import os
+import time
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock  # python 2 backport
+from mujinvisioncontrollerclient import visioncontrollerclient
+
+
+class TestFlags(unittest.TestCase):
+    def test_pack_flags(self):
+        flags, flagsMask = visioncontrollerclient._PackFlags({'waitForStop': True, 'removeTask': False})
+        self.assertEqual(flags, 1 << 3)
+        self.assertEqual(flagsMask, (1 << 3) | (1 << 4))
+
+    def test_pack_flags_truthy(self):
+        # packed flags mean the same as the individual fields, which the vision manager reads as true
+        flags, flagsMask = visioncontrollerclient._PackFlags({'metadataOnly': 1})
+        self.assertEqual(flags, 1 << 2)
+        self.assertEqual(flagsMask, 1 << 2)
+
+
+class TestDestroy(unittest.TestCase):
+    def test_destroy_uninitialized(self):
+        # __del__ calls Destroy also when __init__ did not run, e.g. on invalid arguments
+        client = visioncontrollerclient.VisionControllerClient.__new__(visioncontrollerclient.VisionControllerClient)
+        client.Destroy()
+
+
+class TestDefaultContext(unittest.TestCase):
+    def setUp(self):
+        self._savedctx = visioncontrollerclient._DEFAULT_CTX, visioncontrollerclient._DEFAULT_CTX_PID
+        visioncontrollerclient._DEFAULT_CTX = None
+
+    def tearDown(self):
+        if visioncontrollerclient._DEFAULT_CTX is not self._savedctx[0]:
+            visioncontrollerclient._DEFAULT_CTX.term()
+        visioncontrollerclient._DEFAULT_CTX, visioncontrollerclient._DEFAULT_CTX_PID = self._savedctx
+
+    def test_shared(self):
+        ctx = visioncontrollerclient._GetDefaultContext(ioThreads=1)
+        self.assertIs(visioncontrollerclient._GetDefaultContext(), ctx)
+
+    def test_recreated_after_fork(self):
+        ctx = visioncontrollerclient._GetDefaultContext(ioThreads=1)
+        with mock.patch.object(os, 'getpid', return_value=os.getpid() + 1):
+            childctx = visioncontrollerclient._GetDefaultContext(ioThreads=1)
+        self.assertIsNot(childctx, ctx)
+        ctx.term()
+
+
+class TestSocketPool(unittest.TestCase):
+    def setUp(self):
+        self._savedpool = list(visioncontrollerclient._SOCKET_POOL.items())
+        visioncontrollerclient._SOCKET_POOL.clear()
+        patcher = mock.patch.object(visioncontrollerclient.zmqclient, 'ZmqClient', side_effect=self._CreateClient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ctx = mock.Mock(closed=False)
+        patcher = mock.patch.object(visioncontrollerclient, '_GetDefaultContext', return_value=self.ctx)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        with visioncontrollerclient._SOCKET_POOL_LOCK:
+            if visioncontrollerclient._socketPoolReaper is not None:
+                visioncontrollerclient._socketPoolReaper.cancel()
+                visioncontrollerclient._socketPoolReaper = None
+            visioncontrollerclient._SOCKET_POOL.clear()
+            visioncontrollerclient._SOCKET_POOL.update(self._savedpool)
+
+    def _CreateClient(self, hostname, port, **kwargs):
+        client = mock.Mock(port=port)
+        client.IsWaitingReply.return_value = False
+        return client
+
+    def _Acquire(self, port=7004, reusetimeout=40):
+        return visioncontrollerclient._AcquirePooledClient('127.0.0.1', port, self.ctx, 3, None, reusetimeout)
+
+    def _Release(self, client, port=7004, reusetimeout=40):
+        visioncontrollerclient._ReleasePooledClient(client, '127.0.0.1', port, self.ctx, 3, None, reusetimeout)
+
+    def _NumPooled(self):
+        return sum(len(clients) for clients in visioncontrollerclient._SOCKET_POOL.values())
+
+    def test_reuse_by_key(self):
+        client = self._Acquire()
+        self._Release(client)
+        self.assertIsNot(self._Acquire(port=7006), client)
+        self.assertIs(self._Acquire(), client)
+        self.assertEqual(self._NumPooled(), 0)
+
+    def test_expiry(self):
+        with mock.patch.object(visioncontrollerclient.time, 'time', return_value=1000.0):
+            client = self._Acquire(reusetimeout=10)
+            self._Release(client, reusetimeout=10)
+        with mock.patch.object(visioncontrollerclient.time, 'time', return_value=1011.0):
+            self.assertIsNot(self._Acquire(reusetimeout=10), client)
+        client.Destroy.assert_called_once_with()
+        self.assertEqual(self._NumPooled(), 0)
+
+    def test_eviction(self):
+        clients = [self._Acquire(port=port) for port in range(7000, 7001 + visioncontrollerclient._SOCKET_POOL_MAXSIZE)]
+        for client in clients:
+            self._Release(client, port=client.port)
+        self.assertEqual(self._NumPooled(), visioncontrollerclient._SOCKET_POOL_MAXSIZE)
+        clients[0].Destroy.assert_called_once_with()
+        for client in clients[1:]:
+            client.Destroy.assert_not_called()
+
+    def test_waiting_reply_destroyed(self):
+        client = self._Acquire()
+        client.IsWaitingReply.return_value = True
+        self._Release(client)
+        client.SetDestroy.assert_called_once_with()
+        client.Destroy.assert_called_once_with()
+        self.assertEqual(self._NumPooled(), 0)
+
+    def test_reaper(self):
+        client = self._Acquire(reusetimeout=0.05)
+        self._Release(client, reusetimeout=0.05)
+        for _ in range(100):
+            if client.Destroy.called:
+                break
+            time.sleep(0.01)
+        client.Destroy.assert_called_once_with()
+        self.assertEqual(self._NumPooled(), 0)
+
+    def test_set_destroy_not_pooled(self):
+        visionclient = visioncontrollerclient.VisionControllerClient()
+        client = visionclient._commandsocket
+        visionclient.SetDestroy()
+        visionclient.Destroy()
+        client.SetDestroy.assert_called_with()
+        client.Destroy.assert_called_once_with()
+        self.assertEqual(self._NumPooled(), 0)
+
+    def test_destroy_pooled(self):
+        visionclient = visioncontrollerclient.VisionControllerClient()
+        client = visionclient._commandsocket
+        visionclient.Destroy()
+        client.Destroy.assert_not_called()
+        self.assertIs(self._Acquire(), client)
+
+    def test_caller_context_not_pooled(self):
+        # the caller terminates its context after Destroy, which would hang on pooled sockets
+        visionclient = visioncontrollerclient.VisionControllerClient(ctx=mock.Mock(closed=False))
+        client = visionclient._commandsocket
+        visionclient.Destroy()
+        client.Destroy.assert_called_once_with()
+        self.assertEqual(self._NumPooled(), 0)
+
+    def test_reset_after_fork(self):
+        client = self._Acquire()
+        self._Release(client)
+        with mock.patch.object(os, 'getpid', return_value=os.getpid() + 1):
+            self.assertIsNot(self._Acquire(), client)
+        # the pooled clients of the parent are left alone
+        client.Destroy.assert_not_called()
+        visioncontrollerclient._socketPoolPid = os.getpid()
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self._savedpool = list(visioncontrollerclient._SOCKET_POOL.items())
+        visioncontrollerclient._SOCKET_POOL.clear()
+        self.sockets = {}
+        patcher = mock.patch.object(visioncontrollerclient.zmqclient, 'ZmqClient', side_effect=self._CreateClient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = visioncontrollerclient.VisionControllerClient(commandport=7004, ctx=mock.Mock(closed=False))
+
+    def tearDown(self):
+        self.client.SetDestroy()
+        self.client.Destroy()
+        visioncontrollerclient._SOCKET_POOL.clear()
+        visioncontrollerclient._SOCKET_POOL.update(self._savedpool)
+
+    def _CreateClient(self, hostname, port, **kwargs):
+        client = mock.Mock()
+        client.IsWaitingReply.return_value = False
+        self.sockets[port] = client
+        return client
+
+    def test_send_batch(self):
+        self.client._commandsocket.SendCommand.return_value = {'responses': [{'detectionResults': []}, {'visionStatistics': []}]}
+        commands = [{'command': 'GetLatestDetectedObjects'}, {'command': 'GetVisionStatistics', 'taskId': 'task1'}]
+        self.assertEqual(self.client.SendBatch(commands), [{'detectionResults': []}, {'visionStatistics': []}])
+        command = self.sockets[7004].SendCommand.call_args[0][0]
+        self.assertEqual(command, {'command': 'Batch', 'subcommands': commands})
+
+    def test_send_batch_callerid(self):
+        self.client._callerid = 'caller1'
+        self.client._commandsocket.SendCommand.return_value = {'responses': [{'detectionResults': []}]}
+        self.client.SendBatch([{'command': 'GetLatestDetectedObjects'}])
+        command = self.sockets[7004].SendCommand.call_args[0][0]
+        self.assertEqual(command, {'command': 'Batch', 'callerid': 'caller1', 'subcommands': [{'command': 'GetLatestDetectedObjects', 'callerid': 'caller1'}]})
+
+    def test_send_batch_response_count(self):
+        self.client._commandsocket.SendCommand.return_value = {'responses': [{'detectionResults': []}]}
+        with self.assertRaises(visioncontrollerclient.VisionControllerClientError) as cm:
+            self.client.SendBatch([{'command': 'GetLatestDetectedObjects'}, {'command': 'GetVisionStatistics'}])
+        self.assertEqual(cm.exception._type, 'invalidresponse')
+
+    def test_send_batch_subresponse_error(self):
+        self.client._commandsocket.SendCommand.return_value = {'responses': [{'detectionResults': []}, {'error': {'type': 'notask', 'desc': 'no such task'}}]}
+        with self.assertRaises(visioncontrollerclient.VisionControllerClientError) as cm:
+            self.client.SendBatch([{'command': 'GetLatestDetectedObjects'}, {'command': 'GetVisionStatistics'}])
+        self.assertEqual(cm.exception._type, 'notask')
+
+    def test_get_snapshot(self):
+        self.client._commandsocket.SendCommand.return_value = {'responses': [{'detectionResults': []}, {'visionStatistics': []}]}
+        self.client._configurationsocket.SendCommand.return_value = {'taskStatus': 'active'}
+        self.assertEqual(self.client.GetSnapshot(taskId='task1'), {
+            'latestDetectedObjects': {'detectionResults': []},
+            'visionStatistics': {'visionStatistics': []},
+            'taskState': {'taskStatus': 'active'},
+        })
+        self.assertEqual(self.sockets[7004].SendCommand.call_args[0][0]['subcommands'], [
+            {'command': 'GetLatestDetectedObjects', 'taskId': 'task1'},
+            {'command': 'GetVisionStatistics', 'taskId': 'task1'},
+        ])
+        self.assertEqual(self.sockets[7006].SendCommand.call_args[0][0], {'command': 'GetTaskState', 'taskId': 'task1'})
+
+
+@unittest.skipIf(visioncontrollerclient.msgpack is None, 'msgpack is not installed')
+class TestMsgpack(unittest.TestCase):
+    def setUp(self):
+        self._savedpool = list(visioncontrollerclient._SOCKET_POOL.items())
+        visioncontrollerclient._SOCKET_POOL.clear()
+        self.sockets = {}
+        patcher = mock.patch.object(visioncontrollerclient.zmqclient, 'ZmqClient', side_effect=self._CreateClient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ctx = mock.Mock(closed=False)
+        patcher = mock.patch.object(visioncontrollerclient, '_GetDefaultContext', return_value=self.ctx)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = visioncontrollerclient.VisionControllerClient(commandport=7004, useMsgpack=True)
+
+    def tearDown(self):
+        self.client.SetDestroy()
+        self.client.Destroy()
+        with visioncontrollerclient._SOCKET_POOL_LOCK:
+            if visioncontrollerclient._socketPoolReaper is not None:
+                visioncontrollerclient._socketPoolReaper.cancel()
+                visioncontrollerclient._socketPoolReaper = None
+            visioncontrollerclient._SOCKET_POOL.clear()
+            visioncontrollerclient._SOCKET_POOL.update(self._savedpool)
+
+    def _CreateClient(self, hostname, port, **kwargs):
+        client = mock.Mock()
+        client.IsWaitingReply.return_value = False
+        self.sockets[port] = client
+        return client
+
+    def test_handshake(self):
+        self.client._configurationsocket.SendCommand.return_value = {'encoding': 'msgpack'}
+        self.client._commandsocket.SendCommand.return_value = visioncontrollerclient.msgpack.packb({'visionStatistics': []})
+        self.assertEqual(self.client.GetVisionStatistics(taskId='task1'), {'visionStatistics': []})
+        self.assertEqual(self.sockets[7006].SendCommand.call_args[0][0], {'command': 'Ping', 'encoding': 'msgpack'})
+        args, kwargs = self.sockets[7004].SendCommand.call_args
+        self.assertEqual(visioncontrollerclient.msgpack.unpackb(args[0]), {'command': 'GetVisionStatistics', 'taskId': 'task1'})
+        self.assertFalse(kwargs['sendjson'])
+        self.assertFalse(kwargs['recvjson'])
+
+    def test_error_response(self):
+        self.client._configurationsocket.SendCommand.return_value = {'encoding': 'msgpack'}
+        self.client._commandsocket.SendCommand.return_value = visioncontrollerclient.msgpack.packb({'error': {'type': 'notask', 'desc': 'no such task'}})
+        with self.assertRaises(visioncontrollerclient.VisionControllerClientError) as cm:
+            self.client.GetVisionStatistics()
+        self.assertEqual(cm.exception._type, 'notask')
+
+    def test_unknown_encoding(self):
+        self.client._configurationsocket.SendCommand.side_effect = [{'error': {'type': 'unknownencoding', 'desc': 'msgpack'}}, {}]
+        with mock.patch.object(visioncontrollerclient.log, 'warning') as warning:
+            self.assertEqual(self.client.Ping(), {})
+        warning.assert_called_once()
+        self.assertEqual(self.sockets[7006].SendCommand.call_args[0][0], {'command': 'Ping'})
+        self.client._commandsocket.SendCommand.return_value = {'visionStatistics': []}
+        self.assertEqual(self.client.GetVisionStatistics(), {'visionStatistics': []})
+        self.assertEqual(self.sockets[7004].SendCommand.call_args[0][0], {'command': 'GetVisionStatistics'})
+
+    def test_missing_ack(self):
+        self.client._configurationsocket.SendCommand.return_value = {}
+        self.client._commandsocket.SendCommand.return_value = {'visionStatistics': []}
+        with mock.patch.object(visioncontrollerclient.log, 'warning') as warning:
+            self.assertEqual(self.client.GetVisionStatistics(), {'visionStatistics': []})
+        warning.assert_called_once()
+        self.assertEqual(self.sockets[7004].SendCommand.call_args[0][0], {'command': 'GetVisionStatistics'})
+
+    def test_wait_for_response(self):
+        self.client._configurationsocket.SendCommand.return_value = {'encoding': 'msgpack'}
+        self.client.Ping()
+        commandsocket = self.client._commandsocket
+        commandsocket.IsWaitingReply.return_value = True
+        commandsocket.ReceiveCommand.return_value = visioncontrollerclient.msgpack.packb({'detectionResults': []})
+        self.assertEqual(self.client._WaitForResponse(recvjson=True), {'detectionResults': []})
+        self.assertFalse(commandsocket.ReceiveCommand.call_args[1]['recvjson'])
+
+    def test_command_connection_not_pooled(self):
+        self.client._configurationsocket.SendCommand.return_value = {'encoding': 'msgpack'}
+        self.client.Ping()
+        commandsocket = self.client._commandsocket
+        configurationsocket = self.client._configurationsocket
+        self.client.Destroy()
+        commandsocket.Destroy.assert_called_once_with()
+        configurationsocket.Destroy.assert_not_called()
+        self.assertEqual([key[1] for key in visioncontrollerclient._SOCKET_POOL], [7006])
+
+
+class TestPublishedState(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(visioncontrollerclient.zmqsubscriber, 'ZmqSubscriber')
+        self.subscriber = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.client = visioncontrollerclient.VisionControllerClient(ctx=mock.Mock(closed=False))
+        patcher = mock.patch.object(visioncontrollerclient.json, 'loads', side_effect=visioncontrollerclient.json.loads)
+        self.loads = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.client.Destroy()
+
+    def test_unchanged_state(self):
+        self.subscriber.SpinOnce.side_effect = [b'{"a": 1}', b'{"a": 1}']
+        state = self.client.GetPublishedState()
+        state['a'] = 99
+        self.assertEqual(self.client.GetPublishedState(), {'a': 1})
+        self.assertEqual(self.loads.call_count, 1)
+
+    def test_changed_state(self):
+        self.subscriber.SpinOnce.side_effect = [b'{"a": 1}', b'{"a": 2}']
+        self.assertEqual(self.client.GetPublishedState(), {'a': 1})
+        self.assertEqual(self.client.GetPublishedState(), {'a': 2})
+        self.assertEqual(self.loads.call_count, 2)
+
+    def test_empty_state(self):
+        self.subscriber.SpinOnce.side_effect = [b'{}', None]
+        self.assertEqual(self.client.GetPublishedState(), {})
+        self.assertIsNone(self.client.GetPublishedState())
+        self.loads.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,6 +3,12 @@
 # Mujin vision controller client for bin picking task
 
 # system imports
+import atexit
+import collections
+import multiprocessing
+import os
+import threading
+import time
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from typing import Any, Callable, Dict, List, Optional, Tuple, Union # noqa: F401 # used in type check
@@ -12,103 +18,427 @@ if TYPE_CHECKING:
 from mujinplanningclient import zmqclient, zmqsubscriber, TimeoutError
 from . import VisionControllerClientError, VisionControllerTimeoutError
 from . import json
+from . import msgpack
 from . import zmq
 from . import ugettext as _
 
 # logging
 import logging
 log = logging.getLogger(__name__)
+_VERBOSE = getattr(logging, 'VERBOSE', 5) # level of log.verbose, checked before logging on the command paths
+
+# json payloads of the configuration commands without arguments, encoded once
+_STATIC_CONFIGURATION_PAYLOADS = {
+    commandName: json.dumps({'command': commandName}).encode('utf-8')
+    for commandName in ('Ping', 'Cancel', 'Quit', 'GetPublishedState')
+}  # type: Dict[str, bytes]
+
+def _HandleVisionError(response):
+    # type: (Dict) -> None
+    """Raises the error of a vision manager response as VisionControllerClientError.
+    """
+    if isinstance(response['error'], dict):  # until vision manager error handling is resolved
+        raise VisionControllerClientError(response['error'].get('desc', ''), errortype=response['error'].get('type', ''))
+    else:
+        raise VisionControllerClientError(_('Got unknown error from vision manager: %r') % response['error'], errortype='unknownerror')
+
+def _ProcessResponse(response, command=None, recvjson=True, recvmsgpack=False):
+    # type: (Any, Optional[Dict], bool, bool) -> Any
+    """Decodes a vision manager response if needed and raises its error as VisionControllerClientError. Shared by VisionControllerClient and AsyncVisionControllerClient.
+
+    Args:
+        response: The received response, decoded already if recvjson is True and recvmsgpack is False.
+        command (dict, optional): The command the response is for, used in error messages.
+        recvjson (bool, optional): If True, the response is a json or msgpack object, otherwise raw data that is decoded only if it looks like json.
+        recvmsgpack (bool, optional): If True, the response is msgpack data to unpack.
+    """
+    if recvjson:
+        if recvmsgpack:
+            response = msgpack.unpackb(response, raw=False)
+        if 'error' in response:
+            _HandleVisionError(response)
+    else:
+        if response[:1] in (b'{', '{') and response[-1:] in (b'}', '}'):
+            try:
+                parsed = json.loads(response)
+            except ValueError:
+                pass # raw data that only looks like json
+            else:
+                response = parsed
+                if isinstance(response, dict) and 'error' in response:
+                    _HandleVisionError(response)
+        if len(response) == 0:
+            raise VisionControllerClientError(_('Vision command %(command)s failed with empty response %(response)r') % {'command': command, 'response': response}, errortype='emptyresponseerror')
+    return response
+
+# bits of the boolean command flags in the packed 'flags' field, used when the client is not in legacyFlags mode
+_FLAG_BITS = {
+    'metadataOnly': 1 << 2,
+    'waitForStop': 1 << 3,
+    'removeTask': 1 << 4,
+}  # type: Dict[str, int]
+
+def _PackFlags(flags):
+    # type: (Dict[str, Any]) -> Tuple[int, int]
+    """Packs boolean command flags into bit fields.
+
+    Args:
+        flags (dict): Flag names from _FLAG_BITS and their values.
+
+    Returns:
+        tuple(int, int): The bits of the flags that are True, and the bits of all the given flags.
+    """
+    packedflags = 0
+    flagsmask = 0
+    for name, value in flags.items():
+        bit = _FLAG_BITS[name]
+        flagsmask |= bit
+        if value:
+            packedflags |= bit
+    return packedflags, flagsmask
+
+# process-wide zeromq context used by the clients that are not given one, so that they share its io threads
+_DEFAULT_CTX = None  # type: Optional[zmq.Context]
+_DEFAULT_CTX_PID = None  # type: Optional[int] # pid of the process that created _DEFAULT_CTX, a forked child has to create its own
+_DEFAULT_CTX_LOCK = threading.Lock()
+
+def _GetDefaultContext(ioThreads=None):
+    # type: (Optional[int]) -> zmq.Context
+    """Returns the process-wide zeromq context, creating it on first use and again in a forked child, which does not inherit the io threads of the context of its parent.
+
+    Args:
+        ioThreads (int, optional): Number of io threads of the context. Only used when the context is created. If None, half of the cpus.
+    """
+    global _DEFAULT_CTX, _DEFAULT_CTX_PID
+    with _DEFAULT_CTX_LOCK:
+        pid = os.getpid()
+        if _DEFAULT_CTX is None or _DEFAULT_CTX_PID != pid:
+            if ioThreads is None:
+                ioThreads = max(1, multiprocessing.cpu_count() // 2)
+            _DEFAULT_CTX = zmq.Context(io_threads=ioThreads)
+            _DEFAULT_CTX.linger = 100
+            _DEFAULT_CTX_PID = pid
+        return _DEFAULT_CTX
+
+# process-wide pool of idle zmq clients on the process-wide context, so that short-lived VisionControllerClient instances can reuse established connections
+_SOCKET_POOL = collections.OrderedDict()  # type: collections.OrderedDict # (hostname, port, ctx, limit, checkpreemptfn, reusetimeout) -> list of (releasetime, ZmqClient), least recently released key first
+_SOCKET_POOL_LOCK = threading.Lock()
+_SOCKET_POOL_MAXSIZE = 8 # maximum number of idle clients kept in the pool
+_socketPoolPid = os.getpid() # pid of the process owning the pooled clients, a forked child starts with an empty pool
+_socketPoolClosed = False # set at exit, released clients are destroyed from then on
+_socketPoolReaper = None  # type: Optional[threading.Timer] # destroys the expired clients when the pool is not used in the meantime
+
+def _ResetSocketPoolAfterFork():
+    # type: () -> None
+    """Empties the pool inherited from the parent process after a fork. The pooled clients are not destroyed, their sockets belong to the parent. Has to be called with _SOCKET_POOL_LOCK held.
+    """
+    global _socketPoolPid, _socketPoolReaper
+    pid = os.getpid()
+    if _socketPoolPid != pid:
+        _SOCKET_POOL.clear()
+        _socketPoolPid = pid
+        _socketPoolReaper = None # timer threads do not survive a fork
+
+def _PopExpiredPooledClients(now):
+    # type: (float) -> List[zmqclient.ZmqClient]
+    """Removes the clients idle for longer than their reuse timeout, or whose context is closed, from the pool. Has to be called with _SOCKET_POOL_LOCK held.
+
+    Returns:
+        list[zmqclient.ZmqClient]: The removed clients, which the caller should destroy outside of the lock.
+    """
+    expiredclients = []  # type: List[zmqclient.ZmqClient]
+    for key in list(_SOCKET_POOL.keys()):
+        ctx, reusetimeout = key[2], key[5]
+        idleclients = _SOCKET_POOL[key]
+        if ctx.closed:
+            expiredclients.extend(client for releasetime, client in idleclients)
+            idleclients = []
+        else:
+            expiredclients.extend(client for releasetime, client in idleclients if now - releasetime > reusetimeout)
+            idleclients[:] = [(releasetime, client) for releasetime, client in idleclients if now - releasetime <= reusetimeout]
+        if not idleclients:
+            del _SOCKET_POOL[key]
+    return expiredclients
+
+def _ScheduleSocketPoolReaper():
+    # type: () -> None
+    """Starts a timer destroying the pooled clients once the first of them expires, if there is none running. Has to be called with _SOCKET_POOL_LOCK held.
+    """
+    global _socketPoolReaper
+    if _socketPoolReaper is not None or _socketPoolClosed or not _SOCKET_POOL:
+        return
+    expiretime = min(releasetime + key[5] for key, idleclients in _SOCKET_POOL.items() for releasetime, client in idleclients)
+    _socketPoolReaper = threading.Timer(max(0.0, expiretime - time.time()) + 0.01, _ReapSocketPool)
+    _socketPoolReaper.daemon = True
+    _socketPoolReaper.start()
+
+def _ReapSocketPool():
+    # type: () -> None
+    global _socketPoolReaper
+    with _SOCKET_POOL_LOCK:
+        _socketPoolReaper = None
+        _ResetSocketPoolAfterFork()
+        expiredclients = _PopExpiredPooledClients(time.time())
+        _ScheduleSocketPoolReaper()
+    _DestroyPooledClients(expiredclients)
+
+def _DestroyPooledClients(clients):
+    # type: (List[zmqclient.ZmqClient]) -> None
+    for client in clients:
+        try:
+            client.Destroy()
+        except Exception:
+            log.exception('problem destroying pooled zmq client')
+
+def _AcquirePooledClient(hostname, port, ctx, limit, checkpreemptfn, reusetimeout):
+    # type: (str, int, zmq.Context, int, Optional[Callable], float) -> zmqclient.ZmqClient
+    """Returns an idle client connected to hostname:port from the pool, or creates a new one if there is none.
+    """
+    key = (hostname, port, ctx, limit, checkpreemptfn, reusetimeout)
+    client = None
+    with _SOCKET_POOL_LOCK:
+        _ResetSocketPoolAfterFork()
+        expiredclients = _PopExpiredPooledClients(time.time())
+        idleclients = _SOCKET_POOL.get(key)
+        if idleclients:
+            client = idleclients.pop()[1]
+            if not idleclients:
+                del _SOCKET_POOL[key]
+    _DestroyPooledClients(expiredclients)
+    if client is None:
+        client = zmqclient.ZmqClient(hostname, port, ctx=ctx, limit=limit, checkpreemptfn=checkpreemptfn, reusetimeout=reusetimeout)
+    return client
+
+def _ReleasePooledClient(client, hostname, port, ctx, limit, checkpreemptfn, reusetimeout):
+    # type: (zmqclient.ZmqClient, str, int, zmq.Context, int, Optional[Callable], float) -> None
+    """Returns a client acquired with _AcquirePooledClient to the pool. The client is destroyed if it is still waiting for a reply, or if the pool is closed. The least recently released clients are destroyed when the pool is full, and idle clients are destroyed by a timer once they are idle for longer than their reuse timeout.
+    """
+    if _socketPoolClosed or client.IsWaitingReply():
+        client.SetDestroy()
+        _DestroyPooledClients([client])
+        return
+    key = (hostname, port, ctx, limit, checkpreemptfn, reusetimeout)
+    now = time.time()
+    with _SOCKET_POOL_LOCK:
+        _ResetSocketPoolAfterFork()
+        expiredclients = _PopExpiredPooledClients(now)
+        idleclients = _SOCKET_POOL.pop(key, [])
+        idleclients.append((now, client))
+        _SOCKET_POOL[key] = idleclients
+        numidleclients = sum(len(clients) for clients in _SOCKET_POOL.values())
+        while numidleclients > _SOCKET_POOL_MAXSIZE:
+            oldestkey = next(iter(_SOCKET_POOL))
+            oldestclients = _SOCKET_POOL[oldestkey]
+            expiredclients.append(oldestclients.pop(0)[1])
+            if not oldestclients:
+                del _SOCKET_POOL[oldestkey]
+            numidleclients -= 1
+        _ScheduleSocketPoolReaper()
+    _DestroyPooledClients(expiredclients)
+
+@atexit.register
+def _CloseSocketPool():
+    # type: () -> None
+    global _socketPoolClosed
+    with _SOCKET_POOL_LOCK:
+        _ResetSocketPoolAfterFork()
+        _socketPoolClosed = True
+        if _socketPoolReaper is not None:
+            _socketPoolReaper.cancel()
+        clients = [client for idleclients in _SOCKET_POOL.values() for releasetime, client in idleclients]
+        _SOCKET_POOL.clear()
+    _DestroyPooledClients(clients)
 
 class VisionControllerClient(object):
     """Mujin Vision Controller client for binpicking tasks."""
 
-    _ctx = None  # type: Optional[zmq.Context] # zeromq context to use
-    _ctxown = None  # type: Optional[zmq.Context]
-    # if owning the zeromq context, need to destroy it once done, so this value is set
-    hostname = None  # type: Optional[str] # hostname of vision controller
-    commandport = None  # type: Optional[int] # command port of vision controller
-    configurationport = None  # type: Optional[int] # configuration port of vision controller, usually command port + 2
-    statusport = None  # type: Optional[int] # status publishing port of vision manager, usually command port + 3
-
-    _commandsocket = None  # type: Optional[zmqclient.ZmqClient]
-    _configurationsocket = None  # type: Optional[zmqclient.ZmqClient]
-    
-    _callerid = None # the callerid to send to vision
-    _checkpreemptfn = None # called periodically when in a loop
-    
-    _subscriber = None # an instance of ZmqSubscriber, used for subscribing to the state
+    __slots__ = (
+        '_ctx',  # zeromq context to use, the process-wide context if not given
+        '_ioThreads',  # number of io threads of the process-wide context, if this client creates it
+        '_usePool',  # True if no context was given, only the zmq clients on the process-wide context are kept in the socket pool
+        'hostname',  # hostname of vision controller
+        'commandport',  # command port of vision controller
+        'configurationport',  # configuration port of vision controller, usually command port + 2
+        'statusport',  # status publishing port of vision manager, usually command port + 3
+        '_statusendpoint',  # zeromq endpoint of the status publishing port
+        '_commandsocketinst',  # created on first access of _commandsocket
+        '_configurationsocketinst',  # created on first access of _configurationsocket
+        '_initlock',  # protects the lazy creation of the context and the sockets
+        '_isDestroyed',  # True once Destroy was called, sockets are not created anymore then
+        '_callerid',  # the callerid to send to vision
+        '_staticConfigurationPayloads',  # _STATIC_CONFIGURATION_PAYLOADS, including the callerid if there is one
+        '_checkpreemptfn',  # called periodically when in a loop
+        '_reconnectionTimeout',  # reuse timeout of the zmq clients, also the time idle zmq clients are kept in the socket pool
+        '_isSetDestroy',  # True once SetDestroy was called, zmq clients are not returned to the socket pool then
+        '_subscriber',  # an instance of ZmqSubscriber, used for subscribing to the state
+        '_lastRawState',  # the last raw state received by GetPublishedState
+        '_lastDecodedState',  # the decoded _lastRawState, copied again as long as the raw state does not change
+        '_legacyFlags',  # if True, boolean flags are sent as individual command fields, otherwise packed into 'flags' and 'flagsMask'
+        '_encoding',  # encoding of the payloads on the command socket, 'json' or 'msgpack'. None while the msgpack handshake is pending
+        '__weakref__',
+    )
 
     _deprecated = None # used to mark arguments as deprecated (set argument default value to this)
 
-    def __init__(self, hostname='127.0.0.1', commandport=7004, ctx=None, checkpreemptfn=None, reconnectionTimeout=40, callerid=None):
-        # type: (str, int, Optional[zmq.Context], Optional[Callable], float, Optional[str]) -> None
-        """Connects to the vision server, initializes vision server, and sets up parameters
+    def __init__(self, hostname='127.0.0.1', commandport=7004, ctx=None, checkpreemptfn=None, reconnectionTimeout=40, callerid=None, useMsgpack=False, legacyFlags=True, ioThreads=None):
+        # type: (str, int, Optional[zmq.Context], Optional[Callable], float, Optional[str], bool, bool, Optional[int]) -> None
+        """Sets up parameters to connect to the vision server. The zeromq context and the sockets are created on first use.
 
         Args:
             hostname (str, optional): e.g. visioncontroller1
             commandport (int, optional): e.g. 7004
-            ctx (zmq.Context, optional): The ZMQ context
+            ctx (zmq.Context, optional): The ZMQ context. If not given, a process-wide context shared by all clients is used.
             checkpreemptfn (Callable, optional): Called periodically when in a loop. A function handle to preempt the socket. The function should raise an exception if a preempt is desired.
             reconnectionTimeout (float, optional): Sets the "timeout" parameter of the ZmqSocketPool instance
             callerid (str, optional): The callerid to send to vision.
+            useMsgpack (bool, optional): If True, encode the payloads on the command socket with msgpack instead of json. The encoding is negotiated with the vision manager on the first Ping or command, and falls back to json if the vision manager does not support it. (Default: False)
+            legacyFlags (bool, optional): If True, boolean command flags are sent as individual fields. If False, they are packed into the 'flags' integer, with 'flagsMask' marking the flags that were set. The vision manager has to support packed flags. (Default: True)
+            ioThreads (int, optional): Number of io threads of the process-wide ZMQ context. Only used if ctx is not given and the process-wide context does not exist yet. If None, half of the cpus. (Default: None)
         """
+        # set first, Destroy is called from __del__ even if __init__ fails partway
+        self._commandsocketinst = None  # type: Optional[zmqclient.ZmqClient]
+        self._configurationsocketinst = None  # type: Optional[zmqclient.ZmqClient]
+        self._isDestroyed = False
+        self._isSetDestroy = False
+        self._subscriber = None  # type: Optional[zmqsubscriber.ZmqSubscriber]
+        self._lastRawState = None
+        self._lastDecodedState = None  # type: Optional[Dict]
+
         self.hostname = hostname
         self.commandport = commandport
         self.configurationport = commandport + 2
         self.statusport = commandport + 3
+        self._statusendpoint = 'tcp://%s:%d' % (hostname, self.statusport)
         self._callerid = callerid
         self._checkpreemptfn = checkpreemptfn
-
-        if ctx is None:
-            self._ctxown = zmq.Context()
-            self._ctxown.linger = 100
-            self._ctx = self._ctxown
+        if callerid:
+            self._staticConfigurationPayloads = {
+                commandName: json.dumps({'command': commandName, 'callerid': callerid}).encode('utf-8')
+                for commandName in _STATIC_CONFIGURATION_PAYLOADS
+            }
         else:
-            self._ctx = ctx
+            self._staticConfigurationPayloads = _STATIC_CONFIGURATION_PAYLOADS
+        self._reconnectionTimeout = reconnectionTimeout
+        self._legacyFlags = legacyFlags
+
+        self._encoding = 'json'
+        if useMsgpack:
+            if msgpack is None:
+                log.warning('msgpack is not installed, using json encoding for vision commands')
+            else:
+                self._encoding = None
 
-        self._commandsocket = zmqclient.ZmqClient(self.hostname, commandport, ctx=self._ctx, limit=3, checkpreemptfn=checkpreemptfn, reusetimeout=reconnectionTimeout)
-        self._configurationsocket = zmqclient.ZmqClient(self.hostname, self.configurationport, ctx=self._ctx, limit=3, checkpreemptfn=checkpreemptfn, reusetimeout=reconnectionTimeout)
+        # the context and the sockets are created on first use
+        self._ctx = ctx
+        self._usePool = ctx is None
+        self._ioThreads = ioThreads
+        self._initlock = threading.Lock()
 
     def __del__(self):
         self.Destroy()
 
+    def _EnsureContext(self):
+        # type: () -> zmq.Context
+        """Returns the zeromq context, the process-wide one if none was given. Has to be called with _initlock held.
+        """
+        if self._ctx is None:
+            self._ctx = _GetDefaultContext(self._ioThreads)
+        return self._ctx
+
+    def _GetContext(self):
+        # type: () -> zmq.Context
+        assert self._initlock is not None
+        with self._initlock:
+            return self._EnsureContext()
+
+    @property
+    def _commandsocket(self):
+        # type: () -> Optional[zmqclient.ZmqClient]
+        """The zmq client of the command port, created on first access. None once destroyed.
+        """
+        if self._commandsocketinst is None and not self._isDestroyed:
+            with self._initlock:
+                if self._commandsocketinst is None and not self._isDestroyed:
+                    self._commandsocketinst = self._CreateClient(self.commandport)
+        return self._commandsocketinst
+
+    @property
+    def _configurationsocket(self):
+        # type: () -> Optional[zmqclient.ZmqClient]
+        """The zmq client of the configuration port, created on first access. None once destroyed.
+        """
+        if self._configurationsocketinst is None and not self._isDestroyed:
+            with self._initlock:
+                if self._configurationsocketinst is None and not self._isDestroyed:
+                    self._configurationsocketinst = self._CreateClient(self.configurationport)
+        return self._configurationsocketinst
+
+    def _CreateClient(self, port):
+        # type: (int) -> zmqclient.ZmqClient
+        """Creates the zmq client of the port, or takes it from the socket pool. Has to be called with _initlock held.
+        """
+        ctx = self._EnsureContext()
+        if self._IsPooled(port):
+            return _AcquirePooledClient(self.hostname, port, ctx, 3, self._checkpreemptfn, self._reconnectionTimeout)
+        return zmqclient.ZmqClient(self.hostname, port, ctx=ctx, limit=3, checkpreemptfn=self._checkpreemptfn, reusetimeout=self._reconnectionTimeout)
+
+    def _IsPooled(self, port):
+        # type: (int) -> bool
+        """Returns whether the zmq client of the port is kept in the socket pool. A command connection that may carry msgpack is not pooled, so that it is never handed to a json client.
+        """
+        return self._usePool and (port != self.commandport or self._encoding == 'json')
+
     def Destroy(self):
         # type: () -> None
-        self.SetDestroy()
+        self._isDestroyed = True
 
-        if self._commandsocket is not None:
+        # slots are unset when __init__ failed, e.g. on invalid arguments
+        if getattr(self, '_commandsocketinst', None) is not None:
             try:
-                self._commandsocket.Destroy()
-                self._commandsocket = None
-            except Exception as e:
-                log.exception('problem destroying commandsocket: %s', e)
+                self._ReleaseClient(self._commandsocketinst, self.commandport)
+                self._commandsocketinst = None
+            except Exception:
+                log.exception('problem destroying commandsocket')
 
-        if self._configurationsocket is not None:
+        if getattr(self, '_configurationsocketinst', None) is not None:
             try:
-                self._configurationsocket.Destroy()
-                self._configurationsocket = None
-            except Exception as e:
-                log.exception('problem destroying configurationsocket: %s', e)
+                self._ReleaseClient(self._configurationsocketinst, self.configurationport)
+                self._configurationsocketinst = None
+            except Exception:
+                log.exception('problem destroying configurationsocket')
 
-        if self._subscriber is not None:
+        if getattr(self, '_subscriber', None) is not None:
             self._subscriber.Destroy()
             self._subscriber = None
-        
-        if self._ctxown is not None:
-            try:
-                self._ctxown.destroy()
-                self._ctxown = None
-            except Exception as e:
-                log.exception('problem destroying ctxown: %s', e)
 
         self._ctx = None
 
+    def _ReleaseClient(self, client, port):
+        # type: (zmqclient.ZmqClient, int) -> None
+        """Returns the zmq client to the socket pool, or destroys it if it cannot be reused. Clients on a context given by the caller are always destroyed, so that the caller can terminate the context.
+        """
+        if self._isSetDestroy or not self._IsPooled(port):
+            client.SetDestroy()
+            client.Destroy()
+            return
+        _ReleasePooledClient(client, self.hostname, port, self._ctx, 3, self._checkpreemptfn, self._reconnectionTimeout)
+
     def SetDestroy(self):
         # type: () -> None
-        if self._commandsocket is not None:
-            self._commandsocket.SetDestroy()
-        if self._configurationsocket is not None:
-            self._configurationsocket.SetDestroy()
+        self._isSetDestroy = True
+        if self._commandsocketinst is not None:
+            self._commandsocketinst.SetDestroy()
+        if self._configurationsocketinst is not None:
+            self._configurationsocketinst.SetDestroy()
+
+    def _SetFlags(self, command, **flags):
+        # type: (Dict[str, Any], Any) -> None
+        """Sets the boolean flags of the command, either as individual fields or packed depending on legacyFlags.
+        """
+        if self._legacyFlags:
+            command.update(flags)
+        else:
+            command['flags'], command['flagsMask'] = _PackFlags(flags)
 
     def _ExecuteCommand(self, command, fireandforget=False, timeout=2.0, recvjson=True, checkpreempt=True, blockwait=True):
         # type: (Dict, bool, float, bool, bool, bool) -> Any
@@ -122,35 +452,61 @@ class VisionControllerClient(object):
             checkpreempt (bool, optional): If a preempt function should be checked during execution.
             blockwait (bool, optional): If True, will block and wait until function is done. Otherwise user will have to call _ProcessResponse on their own. (Default: True)
         """
-        assert self._commandsocket is not None
-        if self._callerid:
-            command['callerid'] = self._callerid
-        response = self._commandsocket.SendCommand(command, fireandforget=fireandforget, timeout=timeout, recvjson=recvjson, checkpreempt=checkpreempt, blockwait=blockwait)
+        # the socket property is read once, and the json path is checked first as it is the common case
+        commandsocket = self._commandsocket
+        assert commandsocket is not None
+        callerid = self._callerid
+        if callerid:
+            command['callerid'] = callerid
+        encoding = self._encoding
+        if encoding != 'json':
+            if encoding is None:
+                self._NegotiateEncoding(timeout=timeout)
+                encoding = self._encoding
+            if encoding == 'msgpack':
+                # json responses are received raw and unpacked in _ProcessResponse, other responses are returned as is
+                response = commandsocket.SendCommand(msgpack.packb(command, use_bin_type=True), fireandforget=fireandforget, timeout=timeout, sendjson=False, recvjson=False, checkpreempt=checkpreempt, blockwait=blockwait)
+                if blockwait and not fireandforget:
+                    return self._ProcessResponse(response, command=command, recvjson=recvjson, recvmsgpack=recvjson)
+                return response
+        response = commandsocket.SendCommand(command, fireandforget=fireandforget, timeout=timeout, recvjson=recvjson, checkpreempt=checkpreempt, blockwait=blockwait)
         if blockwait and not fireandforget:
             return self._ProcessResponse(response, command=command, recvjson=recvjson)
         return response
 
-    def _ProcessResponse(self, response, command=None, recvjson=True):
-        # type: (Any, Optional[Dict], bool) -> Any
+    def _NegotiateEncoding(self, timeout=2.0):
+        # type: (float) -> Optional[Dict]
+        """Asks the vision manager to use msgpack on the command socket by sending a Ping over the configuration socket. Falls back to json if the vision manager does not acknowledge the encoding.
+
+        Args:
+            timeout (float, optional): Time in seconds after which the command is assumed to have failed. (Default: 2.0)
 
-        def _HandleError(response):
-            # type: (Dict) -> None
-            if isinstance(response['error'], dict):  # until vision manager error handling is resolved
-                raise VisionControllerClientError(response['error'].get('desc', ''), errortype=response['error'].get('type', ''))
-            else:
-                raise VisionControllerClientError(_('Got unknown error from vision manager: %r') % response['error'], errortype='unknownerror')
-        if recvjson:
-            if 'error' in response:
-                _HandleError(response)
+        Returns:
+            dict: The response to the Ping.
+        """
+        command = {
+            'command': 'Ping',
+            'encoding': 'msgpack',
+        }  # type: Dict[str, Any]
+        try:
+            response = self._SendConfiguration(command, timeout=timeout)
+        except VisionControllerClientError as e:
+            if e._type != 'unknownencoding':
+                raise
+            log.warning('vision manager does not support msgpack encoding, using json: %s', e._desc)
+            self._encoding = 'json'
+            return self._SendConfiguration({'command': 'Ping'}, timeout=timeout)
+        if isinstance(response, dict) and response.get('encoding') == 'msgpack':
+            self._encoding = 'msgpack'
         else:
-            if len(response) > 0 and response[0] == '{' and response[-1] == '}':
-                response = json.loads(response)
-                if 'error' in response:
-                    _HandleError(response)
-            if len(response) == 0:
-                raise VisionControllerClientError(_('Vision command %(command)s failed with empty response %(response)r') % {'command': command, 'response': response}, errortype='emptyresponseerror')
+            log.warning('vision manager did not acknowledge msgpack encoding, using json')
+            self._encoding = 'json'
         return response
 
+    def _ProcessResponse(self, response, command=None, recvjson=True, recvmsgpack=False):
+        # type: (Any, Optional[Dict], bool, bool) -> Any
+        return _ProcessResponse(response, command=command, recvjson=recvjson, recvmsgpack=recvmsgpack)
+
     def _WaitForResponse(self, recvjson=True, timeout=None, command=None):
         # type: (bool, Optional[float], Optional[Dict]) -> Dict
         """Waits for a response for a command sent on the RPC socket.
@@ -173,13 +529,14 @@ class VisionControllerClient(object):
                 'commandName': commandName,
             }, errortype='invalidwait')
 
+        recvmsgpack = recvjson and self._encoding == 'msgpack'
         try:
-            response = self._commandsocket.ReceiveCommand(timeout=timeout, recvjson=recvjson)
+            response = self._commandsocket.ReceiveCommand(timeout=timeout, recvjson=recvjson and not recvmsgpack)
         except TimeoutError as e:
             raise VisionControllerTimeoutError(_('Timed out after %.03f seconds to get response message %s from %s:%d: %s') % (timeout, commandName, self.hostname, self.commandport, e), errortype='timeout')
         except Exception as e:
             raise VisionControllerClientError(_('Problem receiving response from the last vision manager async call %s: %s') % (commandName, e), errortype='unknownerror')
-        return self._ProcessResponse(response, command=command, recvjson=recvjson)
+        return self._ProcessResponse(response, command=command, recvjson=recvjson, recvmsgpack=recvmsgpack)
 
     def IsWaitingResponse(self):
         # type: () -> bool
@@ -208,14 +565,32 @@ class VisionControllerClient(object):
             checkpreempt (bool, optional): If a preempt function should be checked during execution.
             recvjson (bool, optional): If True, a json is received.
         """
-        assert self._configurationsocket is not None
+        configurationsocket = self._configurationsocket
+        assert configurationsocket is not None
         if self._callerid:
             configuration['callerid'] = self._callerid
-        response = self._configurationsocket.SendCommand(configuration, fireandforget=fireandforget, timeout=timeout, checkpreempt=checkpreempt)
+        response = configurationsocket.SendCommand(configuration, fireandforget=fireandforget, timeout=timeout, checkpreempt=checkpreempt)
         if not fireandforget:
             return self._ProcessResponse(response, command=configuration, recvjson=recvjson)
         return response
 
+    def _SendRawConfiguration(self, commandName, fireandforget=False, timeout=2.0, checkpreempt=True):
+        # type: (str, bool, float, bool) -> Any
+        """Sends a configuration command without arguments using its pre-encoded payload from _STATIC_CONFIGURATION_PAYLOADS.
+
+        Args:
+            commandName (str): Name of the command.
+            fireandforget (bool, optional): Whether we should return immediately after sending the command. If True, return value is None.
+            timeout (float, optional): Time in seconds after which the command is assumed to have failed.
+            checkpreempt (bool, optional): If a preempt function should be checked during execution.
+        """
+        configurationsocket = self._configurationsocket
+        assert configurationsocket is not None
+        response = configurationsocket.SendCommand(self._staticConfigurationPayloads[commandName], fireandforget=fireandforget, timeout=timeout, sendjson=False, checkpreempt=checkpreempt)
+        if not fireandforget:
+            return self._ProcessResponse(response)
+        return response
+
     #
     # Commands
     #
@@ -237,7 +612,8 @@ class VisionControllerClient(object):
 
                 - taskId (str): The taskId of the created task
         """
-        log.verbose('Starting detection thread...')
+        if log.isEnabledFor(_VERBOSE):
+            log.verbose('Starting detection thread...')
         command = {
             'command': 'StartObjectDetectionTask',
         }  # type: Dict[str, Any]
@@ -266,7 +642,8 @@ class VisionControllerClient(object):
 
                 - taskId (str): The taskId of the created task
         """
-        log.verbose('Starting container detection thread...')
+        if log.isEnabledFor(_VERBOSE):
+            log.verbose('Starting container detection thread...')
         command = {
             'command': 'StartContainerDetectionTask',
         }  # type: Dict[str, Any]
@@ -291,7 +668,8 @@ class VisionControllerClient(object):
         Returns:
             dict: An unstructured dictionary.
         """
-        log.verbose('Starting visualize pointcloud thread...')
+        if log.isEnabledFor(_VERBOSE):
+            log.verbose('Starting visualize pointcloud thread...')
         command = {
             'command': 'StartVisualizePointCloudTask',
         }  # type: Dict[str, Any]
@@ -323,20 +701,20 @@ class VisionControllerClient(object):
 
                 - isStopped (bool): true, if the specific taskId or set of tasks with a specific taskType(s) is stopped
         """
-        log.verbose('Stopping detection thread...')
+        if log.isEnabledFor(_VERBOSE):
+            log.verbose('Stopping detection thread...')
         command = {
             'command': 'StopTask',
-            'waitForStop': waitForStop,
-            'removeTask': removeTask,
         }  # type: Dict[str, Any]
-        if taskTypes is not None:
-            command['taskTypes'] = taskTypes
+        self._SetFlags(command, waitForStop=waitForStop, removeTask=removeTask)
         if taskId is not None:
             command['taskId'] = taskId
         if taskIds is not None:
             command['taskIds'] = taskIds
         if taskType is not None:
             command['taskType'] = taskType
+        if taskTypes is not None:
+            command['taskTypes'] = taskTypes
         if cycleIndex is not None:
             command['cycleIndex'] = cycleIndex
         return self._ExecuteCommand(command, timeout=timeout, fireandforget=fireandforget)
@@ -360,7 +738,8 @@ class VisionControllerClient(object):
 
                 - taskIds (list[str]): List of taskIds that have been resumed
         """
-        log.verbose('Resuming detection thread...')
+        if log.isEnabledFor(_VERBOSE):
+            log.verbose('Resuming detection thread...')
         command = {
             'command': 'ResumeTask',
         }  # type: Dict[str, Any]
@@ -457,12 +836,13 @@ class VisionControllerClient(object):
         Returns:
             str: Raw image data
         """
-        log.verbose("Getting latest detection result images...")
+        if log.isEnabledFor(_VERBOSE):
+            log.verbose("Getting latest detection result images...")
         command = {
             'command': 'GetLatestDetectionResultImages',
             'newerThanResultTimestampMS': newerThanResultTimestampMS,
-            'metadataOnly': metadataOnly,
         }  # type: Dict[str, Any]
+        self._SetFlags(command, metadataOnly=metadataOnly)
         if taskId is not None:
             command['taskId'] = taskId
         if cycleIndex is not None:
@@ -488,7 +868,8 @@ class VisionControllerClient(object):
         Returns:
             str: Binary blob of detection data
         """
-        log.verbose("Getting detection result at %r ...", timestamp)
+        if log.isEnabledFor(_VERBOSE):
+            log.verbose("Getting detection result at %r ...", timestamp)
         command = {
             'command': 'GetDetectionHistory',
             'timestamp': timestamp,
@@ -533,9 +914,74 @@ class VisionControllerClient(object):
             command['taskType'] = taskType
         return self._ExecuteCommand(command, timeout=timeout)
 
+    def SendBatch(self, commands, timeout=2.0):
+        # type: (List[Dict[str, Any]], float) -> List[Any]
+        """Sends several commands to the vision manager in a single roundtrip. The vision manager executes them in order.
+
+        Args:
+            commands (list[dict]): The commands to execute, e.g. {'command': 'GetVisionStatistics', 'taskId': 'task1'}
+            timeout (float, optional): Time in seconds after which the whole batch is assumed to have failed. (Default: 2.0)
+
+        Returns:
+            list: The responses of the commands, in the same order as the commands.
+
+        Raises:
+            VisionControllerClientError: If the batch or any of the commands failed.
+        """
+        callerid = self._callerid
+        if callerid:
+            # each command carries the callerid as if it was sent on its own
+            for subcommand in commands:
+                subcommand['callerid'] = callerid
+        command = {
+            'command': 'Batch',
+            'subcommands': commands,
+        }  # type: Dict[str, Any]
+        response = self._ExecuteCommand(command, timeout=timeout)
+        responses = response.get('responses') or []
+        if len(responses) != len(commands):
+            raise VisionControllerClientError(_('Vision batch of %(numCommands)d commands got %(numResponses)d responses') % {'numCommands': len(commands), 'numResponses': len(responses)}, errortype='invalidresponse')
+        return [self._ProcessResponse(subresponse, command=subcommand) for subcommand, subresponse in zip(commands, responses)]
+
+    def GetSnapshot(self, taskId=None, cycleIndex=None, taskType=None, timeout=2.0):
+        # type: (Optional[str], Optional[str], Optional[str], float) -> Dict[str, Any]
+        """Gets the latest detected objects, the vision statistics and the task state in two roundtrips: one batch on the command socket for the detected objects and the vision statistics, and GetTaskStateService on the configuration socket for the task state.
+
+        Args:
+            taskId (str, optional): If specified, the taskId to retrieve the state from.
+            cycleIndex (str, optional): Unique cycle index string for tracking, backing up, and differentiating cycles.
+            taskType (str, optional): If specified, the task type to retrieve the state from.
+            timeout (float, optional): Time in seconds after which the command is assumed to have failed. (Default: 2.0)
+
+        Returns:
+            dict: A dictionary with the structure:
+
+                - latestDetectedObjects (dict): See GetLatestDetectedObjects
+                - visionStatistics (dict): See GetVisionStatistics
+                - taskState (dict): See GetTaskStateService
+        """
+        query = {}  # type: Dict[str, Any]
+        if taskId is not None:
+            query['taskId'] = taskId
+        if cycleIndex is not None:
+            query['cycleIndex'] = cycleIndex
+        if taskType is not None:
+            query['taskType'] = taskType
+        commands = [
+            dict(query, command='GetLatestDetectedObjects'),
+            dict(query, command='GetVisionStatistics'),
+        ]
+        latestDetectedObjects, visionStatistics = self.SendBatch(commands, timeout=timeout)
+        taskState = self.GetTaskStateService(taskId=taskId, cycleIndex=cycleIndex, taskType=taskType, timeout=timeout)
+        return {
+            'latestDetectedObjects': latestDetectedObjects,
+            'visionStatistics': visionStatistics,
+            'taskState': taskState,
+        }
+
     def Ping(self, timeout=2.0):
         # type: (float) -> Optional[Dict]
-        """Sends a ping to the visionmanager.
+        """Sends a ping to the visionmanager. If msgpack encoding was requested and not negotiated yet, the ping carries the encoding handshake.
 
         Args:
             timeout (float, optional): Time in seconds after which the command is assumed to have failed. (Default: 2.0)
@@ -543,10 +989,9 @@ class VisionControllerClient(object):
         Returns:
             dict: An unstructured dictionary.
         """
-        command = {
-            'command': 'Ping',
-        }  # type: Dict[str, Any]
-        return self._SendConfiguration(command, timeout=timeout)
+        if self._encoding is None:
+            return self._NegotiateEncoding(timeout=timeout)
+        return self._SendRawConfiguration('Ping', timeout=timeout)
 
     def SetLogLevel(self, componentLevels, timeout=2.0):
         # type: (Dict, float) -> Optional[Dict]
@@ -565,40 +1010,38 @@ class VisionControllerClient(object):
         }  # type: Dict[str, Any]
         return self._SendConfiguration(command, timeout=timeout)
 
-    def Cancel(self, timeout=2.0):
-        # type: (float) -> Optional[Dict]
+    def Cancel(self, timeout=2.0, fireandforget=False):
+        # type: (float, bool) -> Optional[Dict]
         """Cancels the current command.
 
         Args:
             timeout (float, optional): Time in seconds after which the command is assumed to have failed. (Default: 2.0)
+            fireandforget (bool, optional): If True, does not wait for the response and returns None immediately. (Default: False)
 
         Returns:
             dict: An unstructured dictionary.
         """
         log.info('Canceling command...')
-        command = {
-            'command': 'Cancel',
-        }  # type: Dict[str, Any]
-        response = self._SendConfiguration(command, timeout=timeout)
-        log.info('Command is stopped.')
+        response = self._SendRawConfiguration('Cancel', fireandforget=fireandforget, timeout=timeout)
+        if not fireandforget:
+            log.info('Command is stopped.')
         return response
 
-    def Quit(self, timeout=2.0):
-        # type: (float) -> Optional[Dict]
+    def Quit(self, timeout=2.0, fireandforget=False):
+        # type: (float, bool) -> Optional[Dict]
         """Quits the visionmanager.
 
         Args:
             timeout (float, optional): Time in seconds after which the command is assumed to have failed. (Default: 2.0)
+            fireandforget (bool, optional): If True, does not wait for the response and returns None immediately. (Default: False)
 
         Returns:
             dict: An unstructured dictionary.
         """
         log.info('Stopping visionserver...')
-        command = {
-            'command': 'Quit',
-        }  # type: Dict[str, Any]
-        response = self._SendConfiguration(command, timeout=timeout)
-        log.info('Visionserver is stopped.')
+        response = self._SendRawConfiguration('Quit', fireandforget=fireandforget, timeout=timeout)
+        if not fireandforget:
+            log.info('Visionserver is stopped.')
         return response
 
     def GetTaskStateService(self, taskId=None, cycleIndex=None, taskType=None, timeout=4.0):
@@ -651,10 +1094,7 @@ class VisionControllerClient(object):
                 - timestamp (int)
                 - version (str)
         """
-        command = {
-            'command': 'GetPublishedState',
-        }  # type: Dict[str, Any]
-        return self._SendConfiguration(command, timeout=timeout)
+        return self._SendRawConfiguration('GetPublishedState', timeout=timeout)
 
 
     # Subscription command (subscribes to the state)
@@ -666,11 +1106,16 @@ class VisionControllerClient(object):
             fireandforget (bool, optional): (Default: False)
 
         Returns:
-            dict: An unstructured dictionary.
+            dict: An unstructured dictionary. The state is decoded again only when it changes, so a new dictionary is returned each time, but its nested values are shared between calls and should not be modified.
         """
         if self._subscriber is None:
-            self._subscriber = zmqsubscriber.ZmqSubscriber('tcp://%s:%d' % (self.hostname, self.statusport), ctx=self._ctx)
+            self._subscriber = zmqsubscriber.ZmqSubscriber(self._statusendpoint, ctx=self._GetContext())
         rawState = self._subscriber.SpinOnce(timeout=timeout, checkpreemptfn=self._checkpreemptfn)
-        if rawState is not None:
-            return json.loads(rawState)
-        return None
+        if rawState is None:
+            return None
+        if not rawState or rawState in (b'{}', '{}'):
+            return {}
+        if rawState != self._lastRawState:
+            self._lastDecodedState = json.loads(rawState)
+            self._lastRawState = rawState
+        return dict(self._lastDecodedState)